@@ -102,10 +102,9 @@ class InferenceSampler(torch.utils.data.sampler.Sampler):
     def _get_local_indices(total_size, world_size, rank):
         shard_size = total_size // world_size
         left = total_size % world_size
-        shard_sizes = [shard_size + int(r < left) for r in range(world_size)]
 
-        begin = sum(shard_sizes[:rank])
-        end = min(sum(shard_sizes[:rank + 1]), total_size)
+        begin = rank * shard_size + min(rank, left)
+        end = begin + shard_size + int(rank < left)
         return range(begin, end)
 
     def __iter__(self):
@@ -1,27 +1,52 @@
 import argparse
+import io
 import itertools
 import json
+import mmap
+import multiprocessing
 import os
 import random
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json
+import pyarrow.parquet as pq
 import sacrebleu
+import soundfile
 import torch
+import torchaudio
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
-from transformers import AutoProcessor, Qwen2AudioForConditionalGeneration
-from transformers.pipelines.audio_utils import ffmpeg_read
-from datasets import load_dataset
+from transformers import AutoProcessor, BatchFeature, BitsAndBytesConfig, CompileConfig, Qwen2AudioForConditionalGeneration
+from datasets import Audio, load_dataset
 
 ds_collections = {
     'covost2': {'path': 'st/covost2_eval.jsonl'}
 }
 
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=3))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=3))
+
+AUDIO_TOKEN = '<|AUDIO|>'
+RESULT_SCHEMA = pa.schema([
+    ('gt', pa.string()),
+    ('response', pa.string()),
+    ('source', pa.string()),
+    ('audio_path', pa.string()),
+])
+VLLM_CHUNK_SIZE = 512
+MAX_NEW_TOKENS = 256
+
 
 class AudioDatasetModified(torch.utils.data.Dataset):
 
-    def __init__(self, dname, split, limit=-1):
-        
+    def __init__(self, dname, split, processor, limit=-1, cache_dir=None):
+
         if dname ==  "en_de":
             ds = load_dataset("fixie-ai/covost2", "en_de")
             prompt="<|audio_bos|><|AUDIO|><|audio_eos|> Detect the language and translate the speech into German: <|en|>"
@@ -32,27 +57,102 @@ class AudioDatasetModified(torch.utils.data.Dataset):
             source = "covost_en_zh_dev"
         else:
             raise NotImplementedError
-        self.ds = ds[split]
+        self.ds = ds[split].cast_column('audio', Audio(sampling_rate=processor.feature_extractor.sampling_rate))
         self.prompt = prompt
         self.source = source
         self.limit = limit
+        self.feature_extractor = processor.feature_extractor
+        pre_prompt, post_prompt = prompt.split(AUDIO_TOKEN)
+        self.prompt_ids = (
+            torch.tensor(processor.tokenizer(pre_prompt).input_ids),
+            torch.tensor(processor.tokenizer(post_prompt).input_ids),
+        )
+        self.audio_token_id = processor.tokenizer.convert_tokens_to_ids(AUDIO_TOKEN)
+        self.cache_dir = os.path.join(cache_dir, f'{dname}_{split}_{len(self)}') if cache_dir else None
+        self.mm = None
 
     def __len__(self):
         if self.limit > 0:
             return min(self.limit, len(self.ds))
         return len(self.ds)
 
+    def cache_exists(self):
+        return os.path.exists(os.path.join(self.cache_dir, 'complete'))
+
+    def prepare_cache(self, rank, world_size):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        indices = InferenceSampler._get_local_indices(len(self), world_size, rank)
+        n_samples = self.feature_extractor.n_samples
+        index = {'lengths': [], 'audio_paths': [], 'gts': []}
+        with open(os.path.join(self.cache_dir, f'audio_{rank}.f16'), 'wb') as f:
+            for data in tqdm(self.ds.select(indices), desc='caching audio'):
+                audio = np.asarray(data['audio']['array'][:n_samples], dtype=np.float16)
+                f.write(audio.tobytes())
+                index['lengths'].append(len(audio))
+                index['audio_paths'].append(data['audio']['path'])
+                index['gts'].append(data['translation'])
+        with open(os.path.join(self.cache_dir, f'index_{rank}.json'), 'w') as f:
+            json.dump(index, f)
+
+    def mark_cache_complete(self, world_size):
+        with open(os.path.join(self.cache_dir, 'complete'), 'w') as f:
+            f.write(str(world_size))
+
+    def load_cache_index(self):
+        with open(os.path.join(self.cache_dir, 'complete')) as f:
+            num_shards = int(f.read())
+        indexes = []
+        for shard in range(num_shards):
+            with open(os.path.join(self.cache_dir, f'index_{shard}.json')) as f:
+                indexes.append(json.load(f))
+        return indexes
+
+    def open_cache(self):
+        indexes = self.load_cache_index()
+        self.mm, shard_ids, offsets = [], [], []
+        self.lengths, self.audio_paths, self.gts = [], [], []
+        for shard, index in enumerate(indexes):
+            path = os.path.join(self.cache_dir, f'audio_{shard}.f16')
+            self.mm.append(np.memmap(path, dtype=np.float16, mode='r') if index['lengths'] else None)
+            shard_ids += [shard] * len(index['lengths'])
+            offsets += np.concatenate([[0], np.cumsum(index['lengths'])[:-1]]).tolist() if index['lengths'] else []
+            self.lengths += index['lengths']
+            self.audio_paths += index['audio_paths']
+            self.gts += index['gts']
+        self.shard_ids = np.array(shard_ids, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def get_audio_lengths(self, indices):
+        if self.cache_dir is not None:
+            lengths = np.concatenate([index['lengths'] for index in self.load_cache_index()])
+            return (lengths[np.asarray(indices)] / self.feature_extractor.sampling_rate).tolist()
+        ds = self.ds.cast_column('audio', Audio(decode=False)).select_columns(['audio']).select(indices)
+        lengths = []
+        for data in ds:
+            audio = data['audio']
+            info = soundfile.info(io.BytesIO(audio['bytes']) if audio['bytes'] else audio['path'])
+            lengths.append(info.duration)
+        return lengths
+
     def __getitem__(self, idx):
-        data = self.ds[idx]
-        audio = data['audio']['array']
-        audio_path = data['audio']['path']
-        sampling_rate = data['audio']['sampling_rate']
-        gt = data['translation']
+        if self.cache_dir is not None:
+            if self.mm is None:
+                self.open_cache()
+            offset = self.offsets[idx]
+            audio = self.mm[self.shard_ids[idx]][offset:offset + self.lengths[idx]].astype(np.float32)
+            sampling_rate = self.feature_extractor.sampling_rate
+            audio_path = self.audio_paths[idx]
+            gt = self.gts[idx]
+        else:
+            data = self.ds[idx]
+            audio = data['audio']['array']
+            sampling_rate = data['audio']['sampling_rate']
+            audio_path = data['audio']['path']
+            gt = data['translation']
 
         return {
             'audio': audio,
             'sampling_rate' : sampling_rate,
-            'prompt': self.prompt,
             'source': self.source,
             'audio_path': audio_path,
             'gt': gt
@@ -61,22 +161,40 @@ class AudioDatasetModified(torch.utils.data.Dataset):
 
 class AudioDataset(torch.utils.data.Dataset):
 
-    def __init__(self, ds):
-        path = ds['path']
-        self.datas = open(path).readlines()
+    def __init__(self, ds, sampling_rate=16000, limit=-1):
+        self.path = ds['path']
+        self.sampling_rate = sampling_rate
+        self.limit = limit
+        with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = [0]
+            pos = mm.find(b'\n')
+            while pos != -1:
+                offsets.append(pos + 1)
+                pos = mm.find(b'\n', pos + 1)
+            if offsets[-1] != len(mm):
+                offsets.append(len(mm))
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.mm = None
 
     def __len__(self):
-        return len(self.datas)
+        if self.limit > 0:
+            return min(self.limit, len(self.offsets) - 1)
+        return len(self.offsets) - 1
 
     def __getitem__(self, idx):
-        data = json.loads(self.datas[idx].strip())
-        audio = data['audio']
+        if self.mm is None:
+            with open(self.path, 'rb') as f:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = json.loads(self.mm[self.offsets[idx]:self.offsets[idx + 1]])
+        audio_path = data['audio']
+        audio = load_audio(audio_path, self.sampling_rate)
         source = data['source']
         prompt = "<|audio_bos|><|AUDIO|><|audio_eos|>"+data['prompt']
         gt = data['gt']
 
         return {
             'audio': audio,
+            'audio_path': audio_path,
             'prompt': prompt,
             'source': source,
             'gt': gt
@@ -86,29 +204,134 @@ def read_audio(audio_path):
     if audio_path.startswith("http://") or audio_path.startswith("https://"):
         # We need to actually check for a real protocol, otherwise it's impossible to use a local file
         # like http_huggingface_co.png
-        inputs = requests.get(audio_path).content
+        inputs = _SESSION.get(audio_path).content
     else:
         with open(audio_path, "rb") as f:
             inputs = f.read()
     return inputs
 
+def load_audio(audio_path, sampling_rate):
+    inputs = io.BytesIO(read_audio(audio_path))
+    if audio_path.lower().endswith(('.wav', '.flac')):
+        audio, sr = soundfile.read(inputs, dtype='float32', always_2d=True)
+        audio = torch.from_numpy(audio.T)
+    else:
+        audio, sr = torchaudio.load(inputs)
+    audio = audio.mean(0)
+    if sr != sampling_rate:
+        audio = torchaudio.functional.resample(audio, sr, sampling_rate)
+    return audio.numpy()
+
+class Batch:
+
+    def __init__(self, inputs, audio_path, source, gt):
+        self.inputs = inputs
+        self.audio_path = audio_path
+        self.source = source
+        self.gt = gt
+
+    def pin_memory(self):
+        for k in self.inputs.keys():
+            self.inputs[k] = self.inputs[k].pin_memory()
+        return self
+
 def collate_fn(inputs, processor):
     input_texts = [_['prompt'] for _ in inputs]
     source = [_['source'] for _ in inputs]
     gt = [_['gt'] for _ in inputs]
-    audio_path = [_['audio'] for _ in inputs]
-    input_audios = [ffmpeg_read(read_audio(_['audio']),sampling_rate=processor.feature_extractor.sampling_rate) for _ in inputs]
+    audio_path = [_['audio_path'] for _ in inputs]
+    input_audios = [_['audio'] for _ in inputs]
     inputs = processor(text=input_texts, audios=input_audios, sampling_rate=processor.feature_extractor.sampling_rate, return_tensors="pt", padding=True)
-    return inputs, audio_path, source, gt
+    return Batch(inputs, audio_path, source, gt)
 
-def collate_fn_modified(inputs, processor):
-    input_texts = [_['prompt'] for _ in inputs]
+def identity_collate_fn(inputs):
+    return inputs
+
+def get_num_audio_tokens(feature_lengths):
+    # same length arithmetic as Qwen2AudioProcessor: conv stride 2, then avg pooling stride 2
+    input_lengths = (feature_lengths - 1) // 2 + 1
+    return (input_lengths - 2) // 2 + 1
+
+def collate_fn_modified(inputs, processor, prompt_ids, audio_token_id, pad_to_max_length=False):
     source = [_['source'] for _ in inputs]
     gt = [_['gt'] for _ in inputs]
     audio_path = [_['audio_path'] for _ in inputs]
-    input_audios = [_['audio'] for _ in inputs]
-    inputs = processor(text=input_texts, audios=input_audios, sampling_rate=processor.feature_extractor.sampling_rate, return_tensors="pt", padding=True)
-    return inputs, audio_path, source, gt
+    feature_extractor = processor.feature_extractor
+    waveform = torch.zeros(len(inputs), feature_extractor.n_samples)
+    for i, _ in enumerate(inputs):
+        audio = torch.as_tensor(_['audio'][:feature_extractor.n_samples])
+        waveform[i, :len(audio)] = audio
+    lengths = torch.tensor([min(len(_['audio']), feature_extractor.n_samples) for _ in inputs])
+    num_frames = (lengths + feature_extractor.hop_length - 1) // feature_extractor.hop_length
+    feature_attention_mask = (torch.arange(feature_extractor.nb_max_frames) < num_frames[:, None]).long()
+    pre_ids, post_ids = prompt_ids
+    num_audio_tokens = get_num_audio_tokens(num_frames)
+    text_len = len(pre_ids) + len(post_ids)
+    if pad_to_max_length:
+        seq_len = text_len + int(get_num_audio_tokens(feature_extractor.nb_max_frames))
+    else:
+        seq_len = text_len + int(num_audio_tokens.max())
+    positions = torch.arange(seq_len) - (seq_len - text_len - num_audio_tokens)[:, None]
+    is_pre = (positions >= 0) & (positions < len(pre_ids))
+    is_audio = (positions >= len(pre_ids)) & (positions < len(pre_ids) + num_audio_tokens[:, None])
+    input_ids = torch.full((len(inputs), seq_len), processor.tokenizer.pad_token_id)
+    input_ids[is_pre] = pre_ids.repeat(len(inputs))
+    input_ids[is_audio] = audio_token_id
+    input_ids[:, seq_len - len(post_ids):] = post_ids
+    attention_mask = (positions >= 0).long()
+    inputs = BatchFeature({
+        'input_ids': input_ids,
+        'attention_mask': attention_mask,
+        'waveform': waveform,
+        'feature_attention_mask': feature_attention_mask,
+    })
+    return Batch(inputs, audio_path, source, gt)
+
+def log_mel_spectrogram(waveform, mel_filters, n_fft, hop_length):
+    window = torch.hann_window(n_fft, device=waveform.device)
+    stft = torch.stft(waveform, n_fft, hop_length, window=window, return_complex=True)
+    magnitudes = stft[..., :-1].abs() ** 2
+    mel_spec = mel_filters.T @ magnitudes
+    log_spec = torch.clamp(mel_spec, min=1e-10).log10()
+    log_spec = torch.maximum(log_spec, log_spec.amax(dim=(1, 2), keepdim=True) - 8.0)
+    return (log_spec + 4.0) / 4.0
+
+def write_results(fout, gts, responses, sources, audio_paths):
+    for gt, response, source, audio_path in zip(gts, responses, sources, audio_paths):
+        fout.write(json.dumps({
+            'gt': gt,
+            'response': response,
+            'source': source,
+            'audio_path': audio_path,
+        }) + '\n')
+
+class DataPrefetcher:
+
+    def __init__(self, loader):
+        self.loader = iter(loader)
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            self.batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        with torch.cuda.stream(self.stream):
+            inputs = self.batch.inputs
+            for k in inputs.keys():
+                inputs[k] = inputs[k].to('cuda', non_blocking=True)
+
+    def next(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self.batch
+        if batch is not None:
+            # the tensors were allocated on the side stream, keep them alive for the compute stream
+            for v in batch.inputs.values():
+                v.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return batch
 
 class InferenceSampler(torch.utils.data.sampler.Sampler):
 
@@ -124,10 +347,9 @@ class InferenceSampler(torch.utils.data.sampler.Sampler):
     def _get_local_indices(total_size, world_size, rank):
         shard_size = total_size // world_size
         left = total_size % world_size
-        shard_sizes = [shard_size + int(r < left) for r in range(world_size)]
 
-        begin = sum(shard_sizes[:rank])
-        end = min(sum(shard_sizes[:rank + 1]), total_size)
+        begin = rank * shard_size + min(rank, left)
+        end = begin + shard_size + int(rank < left)
         return range(begin, end)
 
     def __iter__(self):
@@ -136,6 +358,37 @@ class InferenceSampler(torch.utils.data.sampler.Sampler):
     def __len__(self):
         return len(self._local_indices)
 
+class LengthGroupedInferenceSampler(InferenceSampler):
+
+    def __init__(self, dataset, batch_size, megabatch_factor=8):
+        super().__init__(len(dataset))
+        lengths = dataset.get_audio_lengths(self._local_indices)
+        megabatch_size = batch_size * megabatch_factor
+        positions = range(len(self._local_indices))
+        self._batches = []
+        for begin in range(0, len(positions), megabatch_size):
+            megabatch = sorted(positions[begin:begin + megabatch_size], key=lambda i: lengths[i], reverse=True)
+            for i in range(0, len(megabatch), batch_size):
+                self._batches.append([self._local_indices[j] for j in megabatch[i:i + batch_size]])
+
+    def __iter__(self):
+        yield from self._batches
+
+    def __len__(self):
+        return len(self._batches)
+
+def get_bleu_tokenize(source):
+    text_lan = source.split("_")[-2]
+    if text_lan == "ja":
+        return "ja-mecab"
+    elif text_lan == "zh":
+        return "zh"
+    return "13a"
+
+def compute_bleu(task):
+    source, refs, hyps = task
+    return source, len(refs), sacrebleu.corpus_bleu(hyps, [refs], tokenize=get_bleu_tokenize(source)).score
+
 
 if __name__ == '__main__':
 
@@ -144,111 +397,200 @@ if __name__ == '__main__':
     parser.add_argument('--dataset', type=str, default='en_de')
     parser.add_argument('--split', type=str, default='validation')
     parser.add_argument('--batch-size', type=int, default=1)
-    parser.add_argument('--num-workers', type=int, default=1)
+    parser.add_argument('--num-workers', type=int, default=None)
     parser.add_argument('--seed', type=int, default=0)
     parser.add_argument('--limit', type=int, default=-1)
+    parser.add_argument('--group-by-length', action='store_true')
+    parser.add_argument('--cache-dir', type=str, default=None)
+    parser.add_argument('--load-in-8bit', action='store_true')
+    parser.add_argument('--backend', type=str, default='hf', choices=['hf', 'vllm'])
+    parser.add_argument('--compile', action='store_true')
+    parser.add_argument('--attn-implementation', type=str, default=None, choices=['eager', 'sdpa', 'flash_attention_2'])
     args = parser.parse_args()
 
-    torch.distributed.init_process_group(
-        backend='nccl',
-        world_size=int(os.getenv('WORLD_SIZE', '1')),
-        rank=int(os.getenv('RANK', '0')),
-    )
+    if args.compile and args.load_in_8bit:
+        parser.error('--compile is not supported with --load-in-8bit')
+    if args.compile and args.attn_implementation == 'flash_attention_2':
+        parser.error('--compile is not supported with --attn-implementation flash_attention_2')
+    if args.backend == 'vllm':
+        if int(os.getenv('WORLD_SIZE', '1')) > 1:
+            parser.error('--backend vllm runs as a single process, launch it without torch.distributed')
+        for flag in ('load_in_8bit', 'compile', 'group_by_length', 'attn_implementation'):
+            if getattr(args, flag):
+                parser.error(f"--{flag.replace('_', '-')} is not supported with --backend vllm")
+    if args.dataset in ds_collections:
+        if args.backend == 'vllm':
+            parser.error(f'--dataset {args.dataset} is not supported with --backend vllm')
+        for flag in ('group_by_length', 'cache_dir', 'compile'):
+            if getattr(args, flag):
+                parser.error(f"--{flag.replace('_', '-')} is not supported with --dataset {args.dataset}")
+
+    distributed = args.backend == 'hf'
+    if distributed:
+        torch.distributed.init_process_group(
+            backend='nccl',
+            world_size=int(os.getenv('WORLD_SIZE', '1')),
+            rank=int(os.getenv('RANK', '0')),
+        )
+        rank = torch.distributed.get_rank()
+        world_size = torch.distributed.get_world_size()
+    else:
+        rank, world_size = 0, 1
 
     torch.cuda.set_device(int(os.getenv('LOCAL_RANK', 0)))
 
-    model = Qwen2AudioForConditionalGeneration.from_pretrained(
-        args.checkpoint, device_map='cuda', trust_remote_code=True, torch_dtype='auto').eval()
+    if args.backend == 'hf':
+        quantization_config = None
+        if args.load_in_8bit:
+            quantization_config = BitsAndBytesConfig(
+                load_in_8bit=True, llm_int8_skip_modules=['audio_tower', 'multi_modal_projector', 'lm_head'])
+        model = Qwen2AudioForConditionalGeneration.from_pretrained(
+            args.checkpoint, device_map='cuda', trust_remote_code=True, torch_dtype=torch.bfloat16,
+            attn_implementation=args.attn_implementation or 'sdpa', quantization_config=quantization_config).eval()
+        if args.compile:
+            model.audio_tower = torch.compile(model.audio_tower, mode='reduce-overhead')
 
     processor = AutoProcessor.from_pretrained(args.checkpoint)
 
     processor.tokenizer.padding_side = 'left'
 
     random.seed(args.seed)
-    #dataset = AudioDataset(
-    #    ds=ds_collections[args.dataset],
-    #)
-    dataset = AudioDatasetModified(args.dataset, args.split, limit=args.limit)
+    if args.dataset in ds_collections:
+        dataset = AudioDataset(
+            ds=ds_collections[args.dataset],
+            sampling_rate=processor.feature_extractor.sampling_rate,
+            limit=args.limit,
+        )
+        collate = partial(collate_fn, processor=processor)
+    else:
+        dataset = AudioDatasetModified(args.dataset, args.split, processor, limit=args.limit, cache_dir=args.cache_dir)
+        collate = partial(collate_fn_modified, processor=processor, prompt_ids=dataset.prompt_ids,
+                          audio_token_id=dataset.audio_token_id, pad_to_max_length=args.compile)
+    if args.cache_dir is not None and not dataset.cache_exists():
+        dataset.prepare_cache(rank, world_size)
+        if distributed:
+            torch.distributed.barrier()
+        if rank == 0:
+            dataset.mark_cache_complete(world_size)
+        if distributed:
+            torch.distributed.barrier()
     print("Total samples:", len(dataset))
-    data_loader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        sampler=InferenceSampler(len(dataset)),
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=True,
-        drop_last=False,
-        collate_fn=partial(collate_fn_modified, processor=processor),
-    )
-
-    gts = []
-    sources = []
-    rets = []
-    audio_paths = []
-    for _, (inputs, audio_path, source, gt) in tqdm(enumerate(data_loader)):
-        for k in inputs.keys():
-            inputs[k] = inputs[k].to('cuda')
-        output_ids = model.generate(**inputs, max_new_tokens=256, min_new_tokens=1, do_sample=False)
-        output_ids = output_ids[:, inputs.input_ids.size(1):]
-        output = processor.batch_decode(output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
-        gts.extend(gt)
-        rets.extend(output)
-        sources.extend(source)
-        audio_paths.extend(audio_path)
-
-    torch.distributed.barrier()
-
-    world_size = torch.distributed.get_world_size()
-    merged_gts = [None for _ in range(world_size)]
-    merged_sources = [None for _ in range(world_size)]
-    merged_responses = [None for _ in range(world_size)]
-    merged_audio_paths = [None for _ in range(world_size)]
-    torch.distributed.all_gather_object(merged_gts, gts)
-    torch.distributed.all_gather_object(merged_sources, sources)
-    torch.distributed.all_gather_object(merged_responses, rets)
-    torch.distributed.all_gather_object(merged_audio_paths, audio_paths)
-
-    merged_gts = [_ for _ in itertools.chain.from_iterable(merged_gts)]
-    merged_sources = [_ for _ in itertools.chain.from_iterable(merged_sources)]
-    merged_audio_paths = [_ for _ in itertools.chain.from_iterable(merged_audio_paths)]
-    merged_responses = [
-        _ for _ in itertools.chain.from_iterable(merged_responses)
-    ]
-
-    if torch.distributed.get_rank() == 0:
+    if args.compile:
+        model.generation_config.cache_implementation = 'static'
+        model.generation_config.compile_config = CompileConfig(mode='reduce-overhead')
+    if args.num_workers is None:
+        args.num_workers = max(4, os.cpu_count() // world_size)
+    loader_kwargs = dict(num_workers=args.num_workers)
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=2, multiprocessing_context='forkserver')
+    run_id = [(time.strftime('%y%m%d%H%M%S', time.localtime()), os.getpid())]
+    if distributed:
+        torch.distributed.broadcast_object_list(run_id, src=0)
+    time_prefix, run_pid = run_id[0]
+    part_prefix = f'{args.dataset}_{time_prefix}_{run_pid}'
+    part_file = f'{part_prefix}_part{rank}.jsonl'
+    fout = open(part_file, 'w')
+    if args.backend == 'vllm':
+        from vllm import LLM, SamplingParams
+        llm = LLM(model=args.checkpoint, dtype='bfloat16', limit_mm_per_prompt={'audio': 1})
+        sampling_params = SamplingParams(temperature=0.0, max_tokens=MAX_NEW_TOKENS, min_tokens=1)
+        data_loader = torch.utils.data.DataLoader(
+            dataset=dataset,
+            batch_size=None,
+            **loader_kwargs,
+            collate_fn=identity_collate_fn,
+        )
+        data_iter = iter(data_loader)
+        pbar = tqdm(total=len(dataset))
+        while True:
+            items = list(itertools.islice(data_iter, VLLM_CHUNK_SIZE))
+            if not items:
+                break
+            vllm_inputs = [
+                {'prompt': dataset.prompt, 'multi_modal_data': {'audio': (_['audio'], _['sampling_rate'])}}
+                for _ in items
+            ]
+            outputs = llm.generate(vllm_inputs, sampling_params, use_tqdm=False)
+            write_results(
+                fout,
+                [_['gt'] for _ in items],
+                [_.outputs[0].text for _ in outputs],
+                [_['source'] for _ in items],
+                [_['audio_path'] for _ in items],
+            )
+            pbar.update(len(items))
+        pbar.close()
+    else:
+        if args.group_by_length:
+            sampler_kwargs = dict(batch_sampler=LengthGroupedInferenceSampler(dataset, args.batch_size))
+        else:
+            sampler_kwargs = dict(sampler=InferenceSampler(len(dataset)), batch_size=args.batch_size)
+        data_loader = torch.utils.data.DataLoader(
+            dataset=dataset,
+            **sampler_kwargs,
+            **loader_kwargs,
+            pin_memory=True,
+            drop_last=False,
+            collate_fn=collate,
+        )
+
+        decode_pool = ThreadPoolExecutor(max_workers=1)
+        pending = None
+        feature_extractor = processor.feature_extractor
+        mel_filters = torch.from_numpy(feature_extractor.mel_filters).float().cuda()
+        prefetcher = DataPrefetcher(data_loader)
+        batch = prefetcher.next()
+        pbar = tqdm(total=len(data_loader))
+        while batch is not None:
+            inputs = batch.inputs
+            if 'waveform' in inputs:
+                inputs['input_features'] = log_mel_spectrogram(
+                    inputs.pop('waveform'), mel_filters, feature_extractor.n_fft, feature_extractor.hop_length)
+            with torch.inference_mode(), torch.autocast('cuda', dtype=torch.bfloat16):
+                output_ids = model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, min_new_tokens=1, do_sample=False)
+            output_ids = output_ids[:, inputs.input_ids.size(1):].cpu()
+            output = decode_pool.submit(processor.batch_decode, output_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+            if pending is not None:
+                gt, output_prev, source, audio_path = pending
+                write_results(fout, gt, output_prev.result(), source, audio_path)
+            pending = (batch.gt, output, batch.source, batch.audio_path)
+            batch = prefetcher.next()
+            pbar.update(1)
+        if pending is not None:
+            gt, output_prev, source, audio_path = pending
+            write_results(fout, gt, output_prev.result(), source, audio_path)
+        decode_pool.shutdown()
+        pbar.close()
+
+    fout.close()
+    if distributed:
+        torch.distributed.barrier()
+
+    if rank == 0:
         print(f"Evaluating {args.dataset} ...")
 
-        results = []
-        for gt, response, source, audio_path in zip(merged_gts, merged_responses, merged_sources, merged_audio_paths):
-            results.append({
-                'gt': gt,
-                'response': response,
-                'source': source,
-                'audio_path': audio_path,
-            })
-        time_prefix = time.strftime('%y%m%d%H%M%S', time.localtime())
-        results_file = f'{args.dataset}_{time_prefix}.json'
-        json.dump(results, open(results_file, 'w'))
-        results_dict = {}
-        for item in tqdm(results):
-            source = item["source"]
-            results_dict.setdefault(source, []).append(item)
-        for source in results_dict:
-            text_lan = source.split("_")[-2]
-            if text_lan == "ja":
-                text_lan = "ja-mecab"
-            elif text_lan == "zh":
-                text_lan = "zh"
-            else:
-                text_lan = "13a"
-            refs, hyps = [], []
-            results_list = results_dict[source]
-            for result in results_list:
-                gt = result["gt"]
-                response = result["response"]
-                refs.append(gt)
-                hyps.append(response)
-            bleu = sacrebleu.corpus_bleu(hyps,[refs], tokenize=text_lan).score
-            print(f"source: {source}  cnt: {len(refs)} bleu score: {bleu:.4f}")
-
-
-    torch.distributed.barrier()
+        tables = []
+        for part_rank in range(world_size):
+            part_file = f'{part_prefix}_part{part_rank}.jsonl'
+            if os.path.getsize(part_file) > 0:
+                tables.append(pa.json.read_json(
+                    part_file, parse_options=pa.json.ParseOptions(explicit_schema=RESULT_SCHEMA)))
+            os.remove(part_file)
+        results = pa.concat_tables(tables)
+        results_file = f'{args.dataset}_{time_prefix}.parquet'
+        pq.write_table(results, results_file)
+        tasks = []
+        for source in results['source'].unique().to_pylist():
+            rows = results.filter(pc.equal(results['source'], source))
+            tasks.append((source, rows['gt'].to_pylist(), rows['response'].to_pylist()))
+        if len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(len(tasks), os.cpu_count()),
+                                     mp_context=multiprocessing.get_context('forkserver')) as pool:
+                scores = list(pool.map(compute_bleu, tasks))
+        else:
+            scores = [compute_bleu(task) for task in tasks]
+        for source, cnt, bleu in scores:
+            print(f"source: {source}  cnt: {cnt} bleu score: {bleu:.4f}")
+
+    if distributed:
+        torch.distributed.barrier()